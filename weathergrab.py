@@ -1,7 +1,24 @@
 #!/usr/bin/env python3
-import datetime, re, tzlocal, json, os, PIL, sys, argparse
+import datetime, tzlocal, json, os, PIL, sys, argparse, functools, gzip, concurrent.futures, math, hashlib
 from noaa_sdk import NOAA
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw, ImageFont, PngImagePlugin
+import numpy as np
+# Pillow 9.1 moved these constants into enums; older installs (e.g. Raspberry Pi OS Bullseye) only have the flat names
+try:
+  LAYOUT_BASIC = ImageFont.Layout.BASIC
+  ROTATE_90 = Image.Transpose.ROTATE_90
+  DITHER_NONE = Image.Dither.NONE
+except AttributeError:
+  LAYOUT_BASIC = ImageFont.LAYOUT_BASIC
+  ROTATE_90 = Image.ROTATE_90
+  DITHER_NONE = Image.NONE
+try:
+  import orjson
+  jsonLoads = orjson.loads
+  jsonDumps = orjson.dumps
+except ImportError:
+  jsonLoads = json.loads
+  jsonDumps = lambda obj: json.dumps(obj, separators=(',', ':')).encode('utf-8')
 
 def type_hours(string):
     val = int(string)
@@ -42,6 +59,22 @@ def mark_notified(time):
   with open(notification_cachefile, 'w') as outfil:
     json.write({'last':time.strftime(dtFormat)}, outfil)
 
+def send_notification():
+  try:
+    from pushover import Client
+    api_keys = load_pushover_data()
+    api = api_keys.get('api')
+    user = api_keys.get('user')
+    if api is not None and user is not None and len(api) > 0 and len(user) > 0:
+      client = Client(user, api_token=api)
+      with open('weather.png', 'rb') as imgfile:
+        client.send_message('Weather update for today', title='Weather ' + localNow.strftime(dFormat), attachment=imgfile)
+
+      if not args.test:
+       mark_notified(localNow)
+  except ImportError:
+    pass
+
 parser = argparse.ArgumentParser()
 parser.add_argument('--test', action='store_true', help='Enable test mode; always sends notification to pushover')
 parser.add_argument('--no-epaper', action='store_true', help='Do *not* output to the e-paper display')
@@ -53,49 +86,55 @@ def printd(*pargs, **kwargs):
     if args.debug_output:
         print(*pargs, **kwargs)
 
-font_title = ImageFont.truetype('RictyDiminished-Bold.ttf', 24)
-font_labels = ImageFont.truetype('RictyDiminished-Bold.ttf', 14)
-
 weather_zip = '27529'
 weather_country = 'US'
 localTz = tzlocal.get_localzone()
 localNow = datetime.datetime.now(localTz)
 measureStart = localNow.replace(hour=int(localNow.hour/12)*12, minute=0, second=0, microsecond=0)
-weather_cachefile = 'weather_cache.json'
+weather_cachefile = 'weather_cache.json.gz'
+# The only parts of the NOAA grid data we actually graph; everything else is dropped before caching
+weather_cachekeys = ('updateTime', 'probabilityOfPrecipitation', 'temperature', 'relativeHumidity')
+graph_base_cachefile = 'graph_base.png'
+frame_keyfile = 'weather_frame.key'
 # Add some extra time to the forecast so we can have a nice end to the graph
 oneDayHence = measureStart + datetime.timedelta(days=1, hours=1)
-isoPat = re.compile(r'(?P<timestamp>[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2})(?P<timezone>[\+-][0-9]{2}:[0-9]{2})(/P.+)?')
 
-white = (255,255,255)
-black = (0,0,0)
-red = (255,0,0)
-green = (0,255,0)
-blue = (0,0,255)
-yellow = (255,255,0)
-
-def getLinePoints(values, timeToXFunc, yScaleFactor=None, minValue=None, yAdd=None):
+# The panel's colors in the order of its 4-bit color codes. The graph is drawn as a palette image using these, so
+# the colors below are palette indices and the indices are already what the panel wants
+epaperPalette = ((0,0,0), (255,255,255), (0,255,0), (0,0,255), (255,0,0), (255,255,0), (255,128,0))
+epaperPaletteData = [channel for color in epaperPalette for channel in color]
+black, white, green, blue, red, yellow, orange = range(len(epaperPalette))
+# What we quantize anything else to before sending a frame. Orange is left off the end (so the codes still line up)
+# since the graph never uses it, and otherwise the mid-grey edges of anti-aliased text would be snapped to it
+epaperQuantizePalette = Image.new('P', (1,1))
+epaperQuantizePalette.putpalette(epaperPaletteData[:-3])
+
+def getLinePoints(times, vals, timesToXFunc, yScaleFactor=None, minValue=None, yAdd=None):
     if yScaleFactor is None:
         yScaleFactor = 1
     if yAdd is None:
         yAdd = 0
     if minValue is None:
         minValue = 0
-    points = []
-    for value in values:
-        points.append(
-                (timeToXFunc(value['time']),
-                yAdd+(value['value']-minValue)*yScaleFactor,
-                value['value'])
-            )
-    return points
-
-def extractValues(timeAndValueDict):
-    return [val['value'] for val in timeAndValueDict]
+    # times are epoch seconds and timesToXFunc takes the whole array, so the series gets scaled in one go
+    xs = timesToXFunc(times)
+    ys = yAdd+(vals-minValue)*yScaleFactor
+    # One (x, y, value) row per point
+    return np.column_stack((xs, ys, vals))
+
+def drawRoundedLine(draw, points, fill, width):
+    # Round off the joints with a dot per vertex; much cheaper than joint='curve', which works out a pieslice per joint in Python
+    # Samples the forecast didn't cover come through as NaN, so leave them out rather than handing them to PIL
+    points = points[np.isfinite(points).all(axis=1)]
+    if len(points) == 0:
+        return
+    draw.line(points.ravel().tolist(), fill=fill, width=width)
+    radius = width/2.0
+    for x, y in points[1:-1].tolist():
+        draw.ellipse((x-radius, y-radius, x+radius, y+radius), fill=fill)
 
 def drawGraph(date, curTime, whenUpdated, location, graphData):
     imageArea = (640,400)
-    img = Image.new('RGB', imageArea, (255,255,255))
-    draw = ImageDraw.Draw(img)
     exteriorImagePadding = (38, 20)
     graphPadding = (5,5)
     majorDivisions = 4
@@ -126,28 +165,32 @@ def drawGraph(date, curTime, whenUpdated, location, graphData):
     # We make the graph slightly smaller than the outline area, 5 px padding on all sides
     graphSize = (graphArea[0][1] - graphArea[0][0] - (graphPadding[0]*2), graphArea[1][1] - graphArea[1][0] - (graphPadding[1]*2))
 
-    beginTime = graphData[0]['time']
-    endTime = graphData[-1]['time']
+    times = graphData['time']
+    beginTime = datetime.datetime.fromtimestamp(times[0], localTz)
+    endTime = datetime.datetime.fromtimestamp(times[-1], localTz)
     roundBegin = beginTime.replace(minute=0 if beginTime.minute < 30 else 30, second=0, microsecond=0)
     roundEnd = endTime.replace(hour=endTime.hour+1 if endTime.minute>=30 else endTime.hour, minute=30 if endTime.minute < 30 else 0, second=0, microsecond=0)
-    timeRange = roundEnd - roundBegin
-    hoursDisplayed = int(timeRange / datetime.timedelta(hours=1))
+    # Everything on the x axis works in epoch seconds, so the lines, marks and marker agree even across a DST change
+    roundBeginSecs = roundBegin.timestamp()
+    timeRangeSecs = roundEnd.timestamp() - roundBeginSecs
+    hoursDisplayed = int(timeRangeSecs / 3600)
     baseDate = date.replace(hour=int(roundBegin.hour/3)*3, minute=0, second=0, microsecond=0)
 
-    if args.current_time is not None:
-        curTime = beginTime.replace(hour=beginTime.hour+args.current_time)
-    
-    temperatures = [{'time':val['time'], 'value':val['temperature']} for val in graphData]
-    chancePrecips = [{'time':val['time'], 'value':val['probabilityOfPrecipitation']} for val in graphData]
-    humidities = [{'time':val['time'], 'value':val['relativeHumidity']} for val in graphData]
+    temperatures = graphData['temperature']
+    chancePrecips = graphData['probabilityOfPrecipitation']
+    humidities = graphData['relativeHumidity']
+
+    def timesToGraphX(inTimes):
+        return graphArea[0][0]+graphPadding[0]+((inTimes - roundBeginSecs)/timeRangeSecs)*graphSize[0]
 
     def timeToGraphX(inTime):
-        return graphArea[0][0]+graphPadding[0]+((inTime - roundBegin)/timeRange)*graphSize[0]
+        return timesToGraphX(inTime.timestamp())
     
-    tempExtremes = (min([val['value'] for val in temperatures]), max([val['value'] for val in temperatures]))
+    finiteTemps = temperatures[np.isfinite(temperatures)]
+    tempExtremes = (finiteTemps.min(), finiteTemps.max()) if len(finiteTemps) else (np.nan, np.nan)
     tempExtents = (min(50, tempExtremes[0]-10), max(60, tempExtremes[1]+10))
 
-    measurePoints = max(len(chancePrecips), len(temperatures), len(humidities))
+    measurePoints = len(times)
     pointIncrease = graphSize[0] / float(measurePoints)
     quarterIncrease = graphSize[0]/float(majorDivisions)
     hourIncrease = graphSize[0]/float(hoursDisplayed)
@@ -157,33 +200,30 @@ def drawGraph(date, curTime, whenUpdated, location, graphData):
 
     # Title
     titleLabel = 'Weather for {}'.format(location)
-    titleLabelSize = font_title.getsize(titleLabel)
-    draw.text((titleArea[0][0], titleArea[1][0]), titleLabel, font=font_title, fill=black)
+    titleLabelSize = _tsize(titleLabel)
     # Date
     dateLabel = date.strftime('%A %b %d %Y')
-    dateLabelSize = font_title.getsize(dateLabel)
-    draw.text( (titleArea[0][0], titleArea[1][0]+titleLabelSize[1]+bumpOffset), dateLabel, font=font_title, fill=black)
+    dateLabelSize = _tsize(dateLabel)
     # Min/Max temp
     minMaxTempLabel = 'Low {} High {}'.format(tempFmtLabel.format(tempExtremes[0]), tempFmtLabel.format(tempExtremes[1]))
-    tempLabelSize = font_title.getsize(minMaxTempLabel)
-    draw.text( (titleArea[0][0], titleArea[1][0]+titleLabelSize[1]+dateLabelSize[1]+bumpOffset*2), minMaxTempLabel, font=font_title, fill=black)
+    tempLabelSize = _tsize(minMaxTempLabel)
     # Updated/Updated
     retrLabel = 'Data Updated {}'.format(whenUpdated.strftime('%Y-%m-%d %H:%M:%S'))
     nowLabel = 'Graph Updated {}'.format(curTime.strftime('%H:%M:%S'))
-    retrLabelSize = font_labels.getsize(retrLabel)
-    nowLabelSize = font_labels.getsize(nowLabel)
+    retrLabelSize = _lsize(retrLabel)
+    nowLabelSize = _lsize(nowLabel)
     # Legend
     precipLabel = 'Precip. Chance'
     tempLabel = 'Temperature'
     humidLabel = 'Rel. Humidity'
     curTimeLabel = 'Current Time'
-    precipLabelSize = font_labels.getsize(precipLabel)
-    tempLabelSize = font_labels.getsize(tempLabel)
-    humidLabelSize = font_labels.getsize(humidLabel)
-    curTimeLabelSize = font_labels.getsize(curTimeLabel)
+    precipLabelSize = _lsize(precipLabel)
+    tempLabelSize = _lsize(tempLabel)
+    humidLabelSize = _lsize(humidLabel)
+    curTimeLabelSize = _lsize(curTimeLabel)
 
 
-    # Now that we have the full legend's size, actually draw it all
+    # Now that we have the full legend's size, work out where it all goes
     lineHeights = [0]
     lineHeights.append(lineHeights[-1]+retrLabelSize[1]+bumpOffset)
     lineHeights.append(lineHeights[-1]+nowLabelSize[1]+bumpOffset)
@@ -196,108 +236,149 @@ def drawGraph(date, curTime, whenUpdated, location, graphData):
 
     legendBase = (titleArea[0][1]-lineStarts[0], titleArea[1][0], titleArea[0][1]-lineStarts[1])
 
+    # These are wall-clock times for the labels, so they aren't evenly spaced on a DST day; map each one
+    quarterTimes = [baseDate + datetime.timedelta(hours=6)*i for i in range(5)]
+    quarterXs = timesToGraphX(np.array([tim.timestamp() for tim in quarterTimes]))
+    quarterMarks = list(zip(quarterXs.tolist(), quarterTimes))
+
+    # Everything in here only depends on the location, the day being graphed and the layout, so it gets cached to disk
+    def drawStaticChrome(draw):
+        draw.text((titleArea[0][0], titleArea[1][0]), titleLabel, font=font_title, fill=black)
+        draw.text( (titleArea[0][0], titleArea[1][0]+titleLabelSize[1]+bumpOffset), dateLabel, font=font_title, fill=black)
+        # The legend labels also need their colors
+        draw.rectangle( ((legendBase[0], legendBase[1]+lineHeights[2]), (legendBase[0]+legendSquareSize[0], legendBase[1]+lineHeights[2]+legendSquareSize[1])), fill=blue)
+        draw.rectangle( ((legendBase[0], legendBase[1]+lineHeights[3]), (legendBase[0]+legendSquareSize[0], legendBase[1]+lineHeights[3]+legendSquareSize[1])), fill=red)
+        draw.rectangle( ((legendBase[2], legendBase[1]+lineHeights[2]), (legendBase[2]+legendSquareSize[0], legendBase[1]+lineHeights[2]+legendSquareSize[1])), fill=green)
+        draw.rectangle( ((legendBase[2], legendBase[1]+lineHeights[3]), (legendBase[2]+legendSquareSize[0], legendBase[1]+lineHeights[3]+legendSquareSize[1])), fill=yellow)
+        draw.text( (legendBase[0]+legendSquareSize[0]+bumpOffset, legendBase[1]+lineHeights[2]), precipLabel, font=font_labels, fill=black)
+        draw.text( (legendBase[0]+legendSquareSize[0]+bumpOffset, legendBase[1]+lineHeights[3]), tempLabel, font=font_labels, fill=black)
+        draw.text( (legendBase[2]+legendSquareSize[0]+bumpOffset, legendBase[1]+lineHeights[2]), humidLabel, font=font_labels, fill=black)
+        draw.text( (legendBase[2]+legendSquareSize[0]+bumpOffset, legendBase[1]+lineHeights[3]), curTimeLabel, font=font_labels, fill=black)
+
+        # outlining the graph area
+        draw.line( ( (graphArea[0][0], graphArea[1][0]), (graphArea[0][1], graphArea[1][0]), (graphArea[0][1], graphArea[1][1]),
+                     (graphArea[0][0], graphArea[1][1]), (graphArea[0][0], graphArea[1][0]) ), fill=black, width=2)
+
+        # Percentage scale
+        highLabel = pctLabel.format(100)
+        lowLabel = pctLabel.format(0)
+        highSize = _lsize(highLabel)
+        lowSize = _lsize(lowLabel)
+        draw.text( (graphArea[0][1]+3, graphArea[1][1]-lowSize[1]), lowLabel, fill=black, font=font_labels)
+        draw.text( (graphArea[0][1]+3, graphArea[1][0]), highLabel, fill=black, font=font_labels)
+
+        # draw time checkpoints
+        for checkpoint in quarterMarks:
+            chkLabel = timeLabel(checkpoint[1])
+            chkSize = _lsize(chkLabel)
+            draw.text( (checkpoint[0]-(chkSize[0]/2.0), graphArea[1][0]-chkSize[1]-3), chkLabel, fill=black, font=font_labels)
+
+    chromeKey = json.dumps([location, date.isoformat(), roundBegin.isoformat(), roundEnd.isoformat(), legendBase, lineHeights])
+    img = None
+    if os.path.isfile(graph_base_cachefile):
+        with Image.open(graph_base_cachefile) as base:
+            if base.mode == 'P' and base.info.get('chromeKey') == chromeKey:
+                img = base.copy()
+    if img is None:
+        printd('Rendering graph chrome and caching in {}'.format(graph_base_cachefile))
+        img = Image.new('P', imageArea, white)
+        img.putpalette(epaperPaletteData)
+        drawStaticChrome(ImageDraw.Draw(img))
+        pngInfo = PngImagePlugin.PngInfo()
+        pngInfo.add_text('chromeKey', chromeKey)
+        img.save(graph_base_cachefile, 'PNG', pnginfo=pngInfo)
+    draw = ImageDraw.Draw(img)
+
+    draw.text( (titleArea[0][0], titleArea[1][0]+titleLabelSize[1]+dateLabelSize[1]+bumpOffset*2), minMaxTempLabel, font=font_title, fill=black)
     draw.text( (legendBase[0], legendBase[1]+lineHeights[0]), retrLabel, font=font_labels, fill=black)
     draw.text( (legendBase[0], legendBase[1]+lineHeights[1]), nowLabel, font=font_labels, fill=black)
-    # The legend labels also need their colors
-    draw.rectangle( ((legendBase[0], legendBase[1]+lineHeights[2]), (legendBase[0]+legendSquareSize[0], legendBase[1]+lineHeights[2]+legendSquareSize[1])), fill=blue)
-    draw.rectangle( ((legendBase[0], legendBase[1]+lineHeights[3]), (legendBase[0]+legendSquareSize[0], legendBase[1]+lineHeights[3]+legendSquareSize[1])), fill=red)
-    draw.rectangle( ((legendBase[2], legendBase[1]+lineHeights[2]), (legendBase[2]+legendSquareSize[0], legendBase[1]+lineHeights[2]+legendSquareSize[1])), fill=green)
-    draw.rectangle( ((legendBase[2], legendBase[1]+lineHeights[3]), (legendBase[2]+legendSquareSize[0], legendBase[1]+lineHeights[3]+legendSquareSize[1])), fill=yellow)
-    draw.text( (legendBase[0]+legendSquareSize[0]+bumpOffset, legendBase[1]+lineHeights[2]), precipLabel, font=font_labels, fill=black)
-    draw.text( (legendBase[0]+legendSquareSize[0]+bumpOffset, legendBase[1]+lineHeights[3]), tempLabel, font=font_labels, fill=black)
-    draw.text( (legendBase[2]+legendSquareSize[0]+bumpOffset, legendBase[1]+lineHeights[2]), humidLabel, font=font_labels, fill=black)
-    draw.text( (legendBase[2]+legendSquareSize[0]+bumpOffset, legendBase[1]+lineHeights[3]), curTimeLabel, font=font_labels, fill=black)
-
-    
-
-    # outlining the graph area
-    draw.line( ( (graphArea[0][0], graphArea[1][0]), (graphArea[0][1], graphArea[1][0]), (graphArea[0][1], graphArea[1][1]),
-                 (graphArea[0][0], graphArea[1][1]), (graphArea[0][0], graphArea[1][0]) ), fill=black, width=2)
 
     # adding the current time marker
-    currTimeMark = graphArea[0][0]+graphPadding[0]+((curTime - roundBegin)/timeRange)*graphSize[0]
+    currTimeMark = timeToGraphX(curTime)
     minXes = ( max(graphArea[0][0]+graphPadding[0], currTimeMark-(currentTimeWidth/2.0)), min(graphArea[0][1]-graphPadding[0], currTimeMark+(currentTimeWidth/2.0)) )
-    draw.rectangle( ((minXes[0], graphArea[1][0]+graphPadding[1]), (minXes[1], graphArea[1][1]-graphPadding[1])), fill=yellow)
+    if minXes[0] <= minXes[1]:
+        draw.rectangle( ((minXes[0], graphArea[1][0]+graphPadding[1]), (minXes[1], graphArea[1][1]-graphPadding[1])), fill=yellow)
 
     # adding the quarter-day marks
-    quarterTimes = [baseDate + datetime.timedelta(hours=6)*i for i in range(5)]
-    quarterMarks = [(timeToGraphX(tim), tim) for tim in quarterTimes]
     for mark in quarterMarks:
         draw.line( ((mark[0], graphArea[1][0]+graphPadding[1]), (mark[0], graphArea[1][1]-graphPadding[1])), fill=black, width=1)
 
     # adding the hourly marks
-    hourTimes = [roundBegin.replace(hour=roundBegin.hour+1 if roundBegin.minute>0 else roundBegin.hour, minute=0) +datetime.timedelta(hours=1)*i for i in range(hoursDisplayed)]
-    hourMarks = [(timeToGraphX(tim), tim) for tim in hourTimes]
-    for mark in hourMarks:
-        draw.line( ((mark[0], graphArea[1][0]+graphPadding[1]), (mark[0], graphArea[1][0]+graphPadding[1]+graphSize[1]/10)), fill=black, width=1)
+    firstHour = roundBegin.replace(hour=roundBegin.hour+1 if roundBegin.minute>0 else roundBegin.hour, minute=0)
+    hourXs = timesToGraphX(firstHour.timestamp() + 3600*np.arange(hoursDisplayed))
+    for markX in hourXs.tolist():
+        draw.line( ((markX, graphArea[1][0]+graphPadding[1]), (markX, graphArea[1][0]+graphPadding[1]+graphSize[1]/10)), fill=black, width=1)
     
     # Temp scale
     highLabel =  tempFmtLabel.format(tempExtents[1])
     lowLabel = tempFmtLabel.format(tempExtents[0])
-    highSize = font_labels.getsize(highLabel)
-    lowSize = font_labels.getsize(lowLabel)
+    highSize = _lsize(highLabel)
+    lowSize = _lsize(lowLabel)
     draw.text( (graphArea[0][0]-lowSize[0]-3, graphArea[1][1]-lowSize[1]), lowLabel, fill=black, font=font_labels)
     draw.text( (graphArea[0][0]-highSize[0]-3, graphArea[1][0]), highLabel, fill=black, font=font_labels)
-    # Percentage scale
-    highLabel = pctLabel.format(100)
-    lowLabel = pctLabel.format(0)
-    highSize = font_labels.getsize(highLabel)
-    lowSize = font_labels.getsize(lowLabel)
-    draw.text( (graphArea[0][1]+3, graphArea[1][1]-lowSize[1]), lowLabel, fill=black, font=font_labels)
-    draw.text( (graphArea[0][1]+3, graphArea[1][0]), highLabel, fill=black, font=font_labels)
 
     # draw precipitation line
-    precipPoints = getLinePoints(chancePrecips, timeToGraphX, yScaleFactor=percentScale, yAdd=graphArea[1][1]-graphPadding[1])
-    draw.line( [(v[0], v[1]) for v in precipPoints], fill=blue, width=10, joint='curve')
+    precipPoints = getLinePoints(times, chancePrecips, timesToGraphX, yScaleFactor=percentScale, yAdd=graphArea[1][1]-graphPadding[1])
+    drawRoundedLine(draw, precipPoints[:, :2], blue, 10)
     # draw temp line
-    tempPoints = getLinePoints(temperatures, timeToGraphX, yScaleFactor=degreeScale, minValue=tempExtents[0], yAdd=graphArea[1][1]-graphPadding[1])
-    draw.line( [(v[0], v[1]) for v in tempPoints], fill=red, width=10, joint='curve')
+    tempPoints = getLinePoints(times, temperatures, timesToGraphX, yScaleFactor=degreeScale, minValue=tempExtents[0], yAdd=graphArea[1][1]-graphPadding[1])
+    drawRoundedLine(draw, tempPoints[:, :2], red, 10)
     # draw humidity line
-    humidPoints = getLinePoints(humidities, timeToGraphX, yScaleFactor=percentScale, yAdd=graphArea[1][1]-graphPadding[1])
-    draw.line( [(v[0], v[1]) for v in humidPoints], fill=green, width=10, joint='curve')
+    humidPoints = getLinePoints(times, humidities, timesToGraphX, yScaleFactor=percentScale, yAdd=graphArea[1][1]-graphPadding[1])
+    drawRoundedLine(draw, humidPoints[:, :2], green, 10)
 
     # draw precipitation checkpoints
     precipCheckpoints = precipPoints[0::7]
-    for checkpoint in precipCheckpoints:
-        chkLabel = pctLabel.format(checkpoint[2])
-        chkSize = font_labels.getsize(chkLabel)
-        draw.text( (checkpoint[0], max(checkpoint[1]-chkSize[1]-3, graphArea[1][0])), chkLabel, fill=black, font=font_labels)
+    precipCheckpoints = precipCheckpoints[np.isfinite(precipCheckpoints).all(axis=1)]
+    for chkX, chkY, chkValue in precipCheckpoints.tolist():
+        chkLabel = pctLabel.format(chkValue)
+        chkSize = _lsize(chkLabel)
+        draw.text( (chkX, max(chkY-chkSize[1]-3, graphArea[1][0])), chkLabel, fill=black, font=font_labels)
     # draw temp checkpoints
     tempCheckpoints = tempPoints[2::7]
-    for checkpoint in tempCheckpoints:
-        chkLabel = tempFmtLabel.format(checkpoint[2])
-        chkSize = font_labels.getsize(chkLabel)
-        draw.text( (checkpoint[0], max(checkpoint[1]-chkSize[1]-3, graphArea[1][0])), chkLabel, fill=black, font=font_labels)
+    tempCheckpoints = tempCheckpoints[np.isfinite(tempCheckpoints).all(axis=1)]
+    for chkX, chkY, chkValue in tempCheckpoints.tolist():
+        chkLabel = tempFmtLabel.format(chkValue)
+        chkSize = _lsize(chkLabel)
+        draw.text( (chkX, max(chkY-chkSize[1]-3, graphArea[1][0])), chkLabel, fill=black, font=font_labels)
     # draw humidity checkpoints
     humidCheckpoints = humidPoints[4::7]
-    for checkpoint in humidCheckpoints:
-        chkLabel = pctLabel.format(checkpoint[2])
-        chkSize = font_labels.getsize(chkLabel)
-        draw.text( (checkpoint[0], max(checkpoint[1]-chkSize[1]-3, graphArea[1][0])), chkLabel, fill=black, font=font_labels)
-    # draw time checkpoints
-    for checkpoint in quarterMarks:
-        chkLabel = timeLabel(checkpoint[1])
-        chkSize = font_labels.getsize(chkLabel)
-        draw.text( (checkpoint[0]-(chkSize[0]/2.0), graphArea[1][0]-chkSize[1]-3), chkLabel, fill=black, font=font_labels)
+    humidCheckpoints = humidCheckpoints[np.isfinite(humidCheckpoints).all(axis=1)]
+    for chkX, chkY, chkValue in humidCheckpoints.tolist():
+        chkLabel = pctLabel.format(chkValue)
+        chkSize = _lsize(chkLabel)
+        draw.text( (chkX, max(chkY-chkSize[1]-3, graphArea[1][0])), chkLabel, fill=black, font=font_labels)
 
     return img
 
 
 def extractTimeFromDuration(inStr):
-    mat = isoPat.match(inStr)
-    if mat is None:
+    # Values look like 2021-01-01T00:00:00+00:00/PT1H; drop the duration and let fromisoformat handle the rest
+    timeStr, _, _ = inStr.partition('/')
+    try:
+        return datetime.datetime.fromisoformat(timeStr).astimezone(localTz)
+    except ValueError:
         return None
-    timeStr = mat.group('timestamp')
-    timeZone = mat.group('timezone').replace(':', '')
-    return datetime.datetime.strptime('{}{}'.format(timeStr, timeZone), '%Y-%m-%dT%X%z').astimezone(localTz)
 
 within24Hours = lambda time: oneDayHence >= time
 
 def extractTimeValues(resultGroup):
-    return [{'value':value['value'], 'validTime':extractTimeFromDuration(value['validTime'])}
-              for value in resultGroup['values']
-              if within24Hours(extractTimeFromDuration(value['validTime']))
-           ]
+    timeValues = []
+    for value in resultGroup['values']:
+        validTime = extractTimeFromDuration(value['validTime'])
+        if validTime is not None and within24Hours(validTime):
+            timeValues.append({'value':value['value'], 'validTime':validTime})
+    return timeValues
+
+def resampleTimeValues(timeValues, sampleTimes):
+    # For every sample time take the latest value already in effect, or the first value if none is yet
+    if len(timeValues) == 0:
+        return np.full(len(sampleTimes), np.nan)
+    validTimes = np.array([value['validTime'].timestamp() for value in timeValues])
+    values = np.array([value['value'] for value in timeValues], dtype=np.float64)
+    order = np.argsort(validTimes, kind='stable')
+    idx = np.searchsorted(validTimes[order], sampleTimes, side='right') - 1
+    return values[order][np.maximum(idx, 0)]
 
 def convertCToF(cel):
     return 1.8 * cel + 32
@@ -312,10 +393,30 @@ def retrieve_weather():
     noaa = NOAA()
     return noaa.get_forecasts(weather_zip, weather_country, type='forecastGridData')
 
+def getbuffer_fast(epd, image):
+    # Does the job of epd.getbuffer without a Python loop over every pixel. Our own graphs are already drawn in the
+    # panel's palette so their pixels are the color codes; for anything else Pillow maps each pixel to the nearest
+    # panel color, and the palette indices it hands back are the color codes
+    if image.size == (epd.height, epd.width):
+        image = image.transpose(ROTATE_90)
+    if image.mode != 'P' or image.getpalette()[:len(epaperPaletteData)] != epaperPaletteData:
+        image = image.convert('RGB').quantize(palette=epaperQuantizePalette, dither=DITHER_NONE)
+    colors = np.asarray(image, dtype=np.uint8)
+    # Two pixels to a byte, left pixel in the high nibble
+    return ((colors[:, 0::2] << 4) | colors[:, 1::2]).tobytes()
+
+def init_epaper(epd):
+    epd.init()
+    epd.Clear()
+
+# The NOAA request, the e-paper clear and the pushover upload are all slow and don't need anything from us, so run
+# them alongside the local work
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+weatherFuture = None
 if os.path.isfile(weather_cachefile):
     printd('Loading cached weather from {}'.format(weather_cachefile))
-    with open(weather_cachefile, 'r') as infil:
-        result = json.load(infil)
+    with gzip.open(weather_cachefile, 'rb') as infil:
+        result = jsonLoads(infil.read())
     updateTime = extractTimeFromDuration(result['updateTime'])
     # if the data is over 24 hours old, repull it
     if updateTime+datetime.timedelta(hours=24) < datetime.datetime.now(localTz):
@@ -323,9 +424,28 @@ if os.path.isfile(weather_cachefile):
         tooOld = True
 if tooOld or result is None:
     printd('Retreiving weather and caching in {}'.format(weather_cachefile))
-    result = retrieve_weather()
-    with open(weather_cachefile, 'w') as outfil:
-        json.dump(result, outfil)
+    weatherFuture = executor.submit(retrieve_weather)
+
+# Everything we draw is plain Latin text, so skip complex (Raqm) text shaping on every label
+font_title = ImageFont.truetype('RictyDiminished-Bold.ttf', 24, layout_engine=LAYOUT_BASIC)
+font_labels = ImageFont.truetype('RictyDiminished-Bold.ttf', 14, layout_engine=LAYOUT_BASIC)
+
+# getsize is gone in newer Pillow; the right and bottom of the text's bounding box are what it used to return,
+# and getbbox gets both from a single layout pass. The same handful of labels get measured over and over, so
+# remember their sizes
+@functools.lru_cache(maxsize=512)
+def _tsize(text):
+    return font_title.getbbox(text)[2:]
+
+@functools.lru_cache(maxsize=512)
+def _lsize(text):
+    return font_labels.getbbox(text)[2:]
+
+if weatherFuture is not None:
+    result = weatherFuture.result()
+    result = {key:result[key] for key in weather_cachekeys}
+    with gzip.open(weather_cachefile, 'wb') as outfil:
+        outfil.write(jsonDumps(result))
 
 updateTime = extractTimeFromDuration(result['updateTime'])
 
@@ -333,54 +453,80 @@ precip = extractTimeValues(result['probabilityOfPrecipitation'])
 temp = extractTimeValues(result['temperature'])
 humid = extractTimeValues(result['relativeHumidity'])
 
-halfHourValues = []
-curTime = measureStart
+# One slot per half hour between the start of the graph and the end of the forecast window
+halfHourStep = datetime.timedelta(minutes=30)
+halfHourCount = math.ceil((oneDayHence - measureStart) / halfHourStep)
+halfHourTimes = np.array([(measureStart + halfHourStep*idx).timestamp() for idx in range(halfHourCount)])
 #print('Here\'s a dump of the lists we\'re using:')
 #print(json.dumps(coerceDatetimesToStrings(precip),indent=1))
 #print(json.dumps(coerceDatetimesToStrings(temp),indent=1))
 #print(json.dumps(coerceDatetimesToStrings(humid),indent=1))
-while curTime < oneDayHence:
-    curPrecip = None
-    curTemp = None
-    curHumid = None
-    for idx in range(0, max(len(precip), len(temp), len(humid))):
-        if idx < len(precip) and (curPrecip is None or curTime >= precip[idx]['validTime']):
-            curPrecip = precip[idx]['value']
-        if idx < len(temp) and (curTemp is None or curTime >= temp[idx]['validTime']):
-            curTemp = temp[idx]['value']
-        if idx < len(humid) and (curHumid is None or curTime >= humid[idx]['validTime']):
-            curHumid = humid[idx]['value']
-    if curPrecip is None or curTemp is None or curHumid is None:
-        printd('Crap, we weren\'t able to find any data for one of these values:\nprecipitation: {}, temperature: {}, humidity: {}'.format(curPrecip, curTemp, curHumid))
-    halfHourValues.append({'time':curTime, 'probabilityOfPrecipitation':curPrecip, 'temperature':convertCToF(curTemp), 'relativeHumidity':curHumid})
-    curTime += datetime.timedelta(minutes=30)
-
-img = drawGraph(measureStart, localNow, updateTime, '{}, {}'.format(weather_zip, weather_country), halfHourValues)
-img.save('weather.png', 'PNG')
-if args.test or should_notify(localNow):
-  try:
-    from pushover import Client
-    api_keys = load_pushover_data()
-    api = api_keys.get('api')
-    user = api_keys.get('user')
-    if api is not None and user is not None and len(api) > 0 and len(user) > 0:
-      client = Client(user, api_token=api)
-      with open('weather.png', 'rb') as imgfile:
-        client.send_message('Weather update for today', title='Weather ' + localNow.strftime(dFormat), attachment=imgfile)
-
-      if not args.test:
-       mark_notified(localNow)
-  except ImportError:
-    pass
-if not args.no_epaper:
-    import epd4in01f
-    printd('Drawing to e-paper...')
-    try:
+halfHourValues = {
+        'time': halfHourTimes,
+        'probabilityOfPrecipitation': resampleTimeValues(precip, halfHourTimes),
+        'temperature': convertCToF(resampleTimeValues(temp, halfHourTimes)),
+        'relativeHumidity': resampleTimeValues(humid, halfHourTimes)
+    }
+missing = [key for key, values in halfHourValues.items() if np.isnan(values).any()]
+if len(missing) > 0:
+    printd('Crap, we weren\'t able to find any data for some of these values: {}'.format(', '.join(missing)))
+
+graphTime = localNow
+if args.current_time is not None:
+    graphTime = measureStart.replace(hour=measureStart.hour+args.current_time)
+
+# If nothing on the graph would change since the last frame, don't bother redrawing it or refreshing the panel.
+# The current time is only tracked to the half hour (the graph's own resolution) so the panel isn't refreshed
+# every run just to nudge the marker along
+graphSlot = graphTime.replace(minute=int(graphTime.minute/30)*30, second=0, microsecond=0)
+frameKey = hashlib.blake2b(jsonDumps([updateTime.isoformat(), measureStart.isoformat(), graphSlot.isoformat(), not args.no_epaper,
+                                      {key:values.tolist() for key, values in halfHourValues.items()}])).hexdigest()
+lastFrameKey = None
+if os.path.isfile(frame_keyfile) and os.path.isfile('weather.png'):
+    with open(frame_keyfile, 'r') as infil:
+        lastFrameKey = infil.read()
+
+# Work this out before touching the panel, so a failure here can't leave it half way through a refresh
+notifyNow = args.test or should_notify(localNow)
+img = None
+notifyFuture = None
+frameShown = True
+if not args.test and frameKey == lastFrameKey:
+    printd('Graph unchanged since the last frame, skipping the redraw')
+    if notifyNow:
+        notifyFuture = executor.submit(send_notification)
+else:
+    # Only start clearing the panel once we know we have something new to put on it
+    epdFuture = None
+    if not args.no_epaper:
+        import epd4in01f
         epd = epd4in01f.EPD()
-        epd.init()
-        epd.Clear()
-        epd.display(epd.getbuffer(img))
-        epd.sleep()
+        epdFuture = executor.submit(init_epaper, epd)
+    try:
+        img = drawGraph(measureStart, graphTime, updateTime, '{}, {}'.format(weather_zip, weather_country), halfHourValues)
+        img.save('weather.png', 'PNG')
+        if notifyNow:
+            notifyFuture = executor.submit(send_notification)
+        if epdFuture is not None:
+            # Pack the frame while the panel is still busy clearing
+            epdBuffer = getbuffer_fast(epd, img)
+            printd('Drawing to e-paper...')
+            epdFuture.result()
+            epd.display(epdBuffer)
+            epd.sleep()
+            printd('Drawing complete')
     except:
+        if epdFuture is None:
+            raise
+        # Let the clear finish before letting go of the panel, so it isn't left powered up
+        concurrent.futures.wait([epdFuture])
         epd4in01f.epdconfig.module_exit()
-    printd('Drawing complete')
+        frameShown = False
+        if img is None:
+            raise
+if notifyFuture is not None:
+  notifyFuture.result()
+if img is not None and frameShown:
+    with open(frame_keyfile, 'w') as outfil:
+        outfil.write(frameKey)
+executor.shutdown()